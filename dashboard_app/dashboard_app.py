@@ -126,23 +126,184 @@ def load_data():
 df_idpos, df_planogram = load_data()
 
 
-# ヘルパー関数: 指定期間のID-POSデータを集計する
-def get_period_total_metrics(df_idpos_data, store_cd, start_date_dt, end_date_dt):
-    if df_idpos_data is None or store_cd is None or start_date_dt is None or end_date_dt is None:
-        return 0.0, 0.0, 0.0, 0.0 
-
-    period_data = df_idpos_data[
-        (df_idpos_data['店舗CD'] == store_cd) &
-        (df_idpos_data['売上日'].dt.date >= start_date_dt.date()) &
-        (df_idpos_data['売上日'].dt.date <= end_date_dt.date())
-    ]
-    
-    sales_amount = float(period_data['売上金額'].sum()) if '売上金額' in period_data.columns else 0.0
-    sales_quantity = float(period_data['売上数量'].sum()) if '売上数量' in period_data.columns else 0.0
-    id_count = float(period_data['ID数'].sum()) if 'ID数' in period_data.columns else 0.0
-    receipt_count = float(period_data['レシート枚数'].sum()) if 'レシート枚数' in period_data.columns else 0.0
+# --- 祝日カレンダーの読み込み ---
+@st.cache_data
+def load_holiday_calendar():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    holiday_file = os.path.join(script_dir, 'calendar', 'jp_holidays.csv')
+
+    if not os.path.exists(holiday_file):
+        st.warning(f"'{holiday_file}' が見つかりません。祝日なしとして曜日補正を行います。")
+        return pd.DatetimeIndex([])
+
+    try:
+        df_holiday = pd.read_csv(holiday_file)
+        return pd.DatetimeIndex(pd.to_datetime(df_holiday['日付'])).normalize()
+    except Exception as e:
+        st.warning(f"'{holiday_file}' の読み込み中にエラーが発生しました: {e}")
+        return pd.DatetimeIndex([])
+
+holiday_dates = load_holiday_calendar()
+
+
+# --- 展開 (店舗 × テーマ × 展開開始日) × 日付 の指標キューブ ---
+CUBE_METRICS = ['売上金額', '売上数量', 'ID数', 'レシート枚数']
+DAY_TYPE_HOLIDAY = 7 # 曜日区分: 0=月〜6=日, 7=祝日
+DEPLOYMENT_KEY_COLS = ['店舗CD', 'テーマ名', '展開開始日']
+
+@st.cache_resource # 大きな配列を再実行のたびにコピーしないよう cache_resource を使う
+def build_metric_cube(_df_idpos, _df_planogram, _holiday_dates):
+    required_cols = ['店舗CD', 'JAN', '売上日'] + CUBE_METRICS
+    if _df_idpos is None or not all(col in _df_idpos.columns for col in required_cols):
+        return None
+    if _df_planogram is None or not all(col in _df_planogram.columns for col in DEPLOYMENT_KEY_COLS + ['JAN']):
+        return None
+
+    # 店舗CDや売上日が欠損している行は、他の集計と同様に対象外とする
+    _df_idpos = _df_idpos[_df_idpos['店舗CD'].notna() & _df_idpos['売上日'].notna()]
+    if _df_idpos.empty:
+        return None
+
+    sales_dates = _df_idpos['売上日'].dt.normalize()
+    dates = pd.date_range(sales_dates.min(), sales_dates.max(), freq='D')
+    date_codes = (sales_dates - dates[0]).dt.days.to_numpy()
+    metric_values = _df_idpos[CUBE_METRICS].fillna(0).to_numpy(dtype=float)
+
+    # JANグループ: 展開ごとに陳列されたJAN (複数の棚番号に並ぶJANも1回だけ数える)
+    jan_deployment = _df_planogram[DEPLOYMENT_KEY_COLS + ['JAN']].dropna().drop_duplicates()
+    deployment_groups = jan_deployment.groupby(DEPLOYMENT_KEY_COLS, sort=True)
+    jan_deployment = jan_deployment.assign(_group=deployment_groups.ngroup())
+    deployment_keys = deployment_groups.size().index.tolist()
+
+    matched = _df_idpos[['店舗CD', 'JAN']].assign(_row=np.arange(len(_df_idpos))).merge(
+        jan_deployment[['店舗CD', 'JAN', '_group']], on=['店舗CD', 'JAN'], how='inner'
+    )
+    row_positions = matched['_row'].to_numpy()
+    group_codes = matched['_group'].to_numpy()
+
+    # (展開, 日付) を1次元のインデックスにまとめて bincount で一括集計する
+    n_groups, n_dates = len(deployment_keys), len(dates)
+    flat_index = group_codes * n_dates + date_codes[row_positions]
+    values = np.empty((n_groups, n_dates, len(CUBE_METRICS)))
+    for m in range(len(CUBE_METRICS)):
+        values[..., m] = np.bincount(
+            flat_index, weights=metric_values[row_positions, m], minlength=n_groups * n_dates
+        ).reshape(n_groups, n_dates)
+
+    # カレンダー属性 (日付軸に対応)
+    is_holiday = dates.isin(_holiday_dates)
+    if len(_holiday_dates) > 0 and (dates.min().year < _holiday_dates.min().year or dates.max().year > _holiday_dates.max().year):
+        st.warning(f"祝日カレンダーの対象期間 ({_holiday_dates.min().year}〜{_holiday_dates.max().year}年) 外の売上日が含まれています。期間外の祝日は平日として扱われます。")
+
+    return {
+        'values': values,
+        'dates': dates,
+        'deployment_index': {key: i for i, key in enumerate(deployment_keys)},
+        'day_type': np.where(is_holiday, DAY_TYPE_HOLIDAY, dates.dayofweek.to_numpy()),
+    }
+
+metric_cube = build_metric_cube(df_idpos, df_planogram, holiday_dates)
+
+
+# ヘルパー関数: 指定期間に対応するキューブの日付位置 (先頭, 末尾) を返す (データ期間外は切り詰める)
+def get_cube_date_positions(cube, start_date_dt, end_date_dt):
+    if cube is None or start_date_dt is None or end_date_dt is None:
+        return None
+
+    first = max((pd.Timestamp(start_date_dt).normalize() - cube['dates'][0]).days, 0)
+    last = min((pd.Timestamp(end_date_dt).normalize() - cube['dates'][0]).days, len(cube['dates']) - 1)
+    if first > last:
+        return None
+    return first, last
+
+# ヘルパー関数: 展開のJANグループについて、キューブから指定期間の (日次指標, 曜日区分, 日付) を切り出す
+def slice_metric_cube(cube, store_cd, theme_name, deployment_start_dt, start_date_dt, end_date_dt):
+    positions = get_cube_date_positions(cube, start_date_dt, end_date_dt)
+    if positions is None or store_cd is None or deployment_start_dt is None:
+        return None
+
+    group_pos = cube['deployment_index'].get((store_cd, theme_name, pd.Timestamp(deployment_start_dt)))
+    if group_pos is None:
+        return None
+
+    first, last = positions
+    return cube['values'][group_pos, first:last + 1], cube['day_type'][first:last + 1], cube['dates'][first:last + 1]
+
+# ヘルパー関数: 展開のJANグループについて、指定期間の指標合計をキューブから取得する (売上金額, 売上数量, ID数, レシート枚数)
+def get_cube_period_totals(cube, store_cd, theme_name, deployment_start_dt, start_date_dt, end_date_dt):
+    period_slice = slice_metric_cube(cube, store_cd, theme_name, deployment_start_dt, start_date_dt, end_date_dt)
+    if period_slice is None:
+        return np.zeros(len(CUBE_METRICS))
+    return period_slice[0].sum(axis=0)
+
+# ヘルパー関数: 基準期間の曜日区分別の日次平均を、対象期間の曜日構成に当てはめた期待値を返す
+def calculate_weekday_matched_expected(current_day_types, base_values, base_day_types):
+    n_day_types = DAY_TYPE_HOLIDAY + 1
+    base_sums = np.zeros((n_day_types, base_values.shape[1]))
+    np.add.at(base_sums, base_day_types, base_values)
+    base_counts = np.bincount(base_day_types, minlength=n_day_types)
+    type_daily_avg = base_sums / np.maximum(base_counts, 1)[:, None]
+
+    # 基準期間に存在しない曜日区分は全体の日次平均で補う。祝日は土日に近いため、まず土日の日次平均で補う
+    overall_daily_avg = base_values.mean(axis=0)
+    weekend_count = base_counts[5] + base_counts[6]
+    holiday_fallback = (base_sums[5] + base_sums[6]) / weekend_count if weekend_count > 0 else overall_daily_avg
+    fallback = np.tile(overall_daily_avg, (n_day_types, 1))
+    fallback[DAY_TYPE_HOLIDAY] = holiday_fallback
+    type_daily_avg = np.where(base_counts[:, None] > 0, type_daily_avg, fallback)
+
+    return np.bincount(current_day_types, minlength=n_day_types) @ type_daily_avg
+
+# ヘルパー関数: カレンダーを考慮した比較 (ラベル, 対象期間の合計, 比較基準値) の一覧を返す
+# 対象期間・比較基準とも、選択中の展開のJANグループをキューブから切り出して計算する
+def calculate_calendar_comparisons(cube, store_cd, theme_name, current_start, current_end, prev_start, prev_end, trailing_weeks):
+    labels = ['曜日補正 前期間比', '前年同期比 (52週前)', f'直近{trailing_weeks}週比 (曜日補正)']
+    current_slice = slice_metric_cube(cube, store_cd, theme_name, current_start, current_start, current_end)
+    if current_slice is None:
+        return [(label, None, None) for label in labels]
+
+    current_values, current_day_types, current_dates = current_slice
+    current_totals = current_values.sum(axis=0)
+    baselines = []
+
+    # 同じJANの前期間中の曜日別日次平均を、今期間の曜日構成に合わせて比較
+    prev_slice = slice_metric_cube(cube, store_cd, theme_name, current_start, prev_start, prev_end)
+    baselines.append(
+        calculate_weekday_matched_expected(current_day_types, prev_slice[0], prev_slice[1]) if prev_slice is not None else None
+    )
+
+    # 364日前 (同じ曜日並び) の同じ日数と比較。データ期間外にかかる場合は比較しない
+    year_offset = pd.Timedelta(days=364)
+    last_year_slice = slice_metric_cube(cube, store_cd, theme_name, current_start, current_dates[0] - year_offset, current_dates[-1] - year_offset)
+    baselines.append(
+        last_year_slice[0].sum(axis=0) if last_year_slice is not None and len(last_year_slice[2]) == len(current_dates) else None
+    )
+
+    # 今期間開始直前のN週間の曜日別日次平均を、今期間の曜日構成に合わせて比較。N週間分そろわない場合は比較しない
+    trailing_end = pd.Timestamp(current_start).normalize() - pd.Timedelta(days=1)
+    trailing_slice = slice_metric_cube(cube, store_cd, theme_name, current_start, trailing_end - pd.Timedelta(weeks=trailing_weeks) + pd.Timedelta(days=1), trailing_end)
+    baselines.append(
+        calculate_weekday_matched_expected(current_day_types, trailing_slice[0], trailing_slice[1]) if trailing_slice is not None and len(trailing_slice[2]) == trailing_weeks * 7 else None
+    )
+
+    return [(label, current_totals, baseline) for label, baseline in zip(labels, baselines)]
+
+# ヘルパー関数: 比較基準値に対する増減率を色付き文字列で返す
+def format_change_percentage_str(current_value, baseline_value):
+    if baseline_value == 0.0:
+        if current_value > 0.0:
+            return "<span style='font-size: 1.0em; color: red;'>+∞%</span>"
+        else:
+            return "N/A"
+
+    change_percent = ((current_value - baseline_value) / baseline_value) * 100
 
-    return sales_amount, sales_quantity, id_count, receipt_count
+    if change_percent > 0:
+        return f"<span style='font-size: 1.0em; color: red;'>+{change_percent:.1f}%</span>"
+    elif change_percent < 0:
+        return f"<span style='font-size: 1.0em; color: blue;'>{change_percent:.1f}%</span>"
+    else:
+        return "<span style='font-size: 1.0em;'>0.0%</span>"
 
 # ヘルパー関数: 日次平均の増減率を計算し、色付き文字列で返す
 def calculate_daily_change_percentage_str(current_total, current_start, current_end, prev_total, prev_start, prev_end):
@@ -159,20 +320,7 @@ def calculate_daily_change_percentage_str(current_total, current_start, current_
     current_daily_avg = current_total / days_current if days_current > 0 else 0.0
     prev_daily_avg = prev_total / days_prev if days_prev > 0 else 0.0
 
-    if prev_daily_avg == 0.0:
-        if current_daily_avg > 0.0:
-            return "<span style='font-size: 1.0em; color: red;'>+∞%</span>" 
-        else:
-            return "N/A" 
-    
-    change_percent = ((current_daily_avg - prev_daily_avg) / prev_daily_avg) * 100
-
-    if change_percent > 0:
-        return f"<span style='font-size: 1.0em; color: red;'>+{change_percent:.1f}%</span>" 
-    elif change_percent < 0:
-        return f"<span style='font-size: 1.0em; color: blue;'>{change_percent:.1f}%</span>" 
-    else:
-        return "<span style='font-size: 1.0em;'>0.0%</span>" 
+    return format_change_percentage_str(current_daily_avg, prev_daily_avg)
 
 # ヘルパー関数: 日次・累計グラフを作成する
 def create_daily_cumulative_graph(daily_data, metric_name, unit, title, color_daily, color_cumulative):
@@ -299,6 +447,10 @@ if df_planogram is not None and selected_store_name and selected_theme_name:
 else:
     st.sidebar.info("店舗名とテーマ名を選択すると、展開開始日が表示されます。")
 
+# --- 比較ベースラインの設定 ---
+st.sidebar.header("比較条件")
+trailing_weeks = st.sidebar.selectbox("直近N週ベースライン (週数)", [4, 8, 13], index=0)
+
 
 # --- ダッシュボード本体 ---
 # フィルターが選択されていない場合は情報メッセージを表示し、それ以上は処理しない
@@ -457,37 +609,57 @@ else:
                 if not prev_planogram_data_for_end.empty and '展開終了日' in prev_planogram_data_for_end.columns:
                     prev_end_date_dt = prev_planogram_data_for_end['展開終了日'].iloc[0]
             
+            # 前期間比は展開同士で比較する (今回の展開のJAN×今回の期間 vs 前回の展開のJAN×前回の期間)
+            current_deployment_sales_amount, current_deployment_sales_quantity, current_deployment_id_count, current_deployment_receipt_count = \
+                get_cube_period_totals(metric_cube, selected_store_cd_for_comparison, selected_theme_name, selected_start_date, selected_start_date, current_end_date_dt)
             prev_sales_amount, prev_sales_quantity, prev_id_count, prev_receipt_count = \
-                get_period_total_metrics(df_idpos, selected_store_cd_for_comparison, prev_start_date_dt, prev_end_date_dt)
+                get_cube_period_totals(metric_cube, selected_store_cd_for_comparison, selected_theme_name, prev_start_date_dt, prev_start_date_dt, prev_end_date_dt)
 
-            change_sales_amount_str = calculate_daily_change_percentage_str(current_sales_amount, selected_start_date, current_end_date_dt, prev_sales_amount, prev_start_date_dt, prev_end_date_dt)
-            change_sales_quantity_str = calculate_daily_change_percentage_str(current_sales_quantity, selected_start_date, current_end_date_dt, prev_sales_quantity, prev_start_date_dt, prev_end_date_dt)
-            change_id_count_str = calculate_daily_change_percentage_str(current_id_count, selected_start_date, current_end_date_dt, prev_id_count, prev_start_date_dt, prev_end_date_dt)
-            change_receipt_count_str = calculate_daily_change_percentage_str(current_receipt_count, selected_start_date, current_end_date_dt, prev_receipt_count, prev_start_date_dt, prev_end_date_dt)
+            change_sales_amount_str = calculate_daily_change_percentage_str(current_deployment_sales_amount, selected_start_date, current_end_date_dt, prev_sales_amount, prev_start_date_dt, prev_end_date_dt)
+            change_sales_quantity_str = calculate_daily_change_percentage_str(current_deployment_sales_quantity, selected_start_date, current_end_date_dt, prev_sales_quantity, prev_start_date_dt, prev_end_date_dt)
+            change_id_count_str = calculate_daily_change_percentage_str(current_deployment_id_count, selected_start_date, current_end_date_dt, prev_id_count, prev_start_date_dt, prev_end_date_dt)
+            change_receipt_count_str = calculate_daily_change_percentage_str(current_deployment_receipt_count, selected_start_date, current_end_date_dt, prev_receipt_count, prev_start_date_dt, prev_end_date_dt)
+
+            # カレンダーを考慮した比較 (選択中の展開のJANグループについて、キューブの切り出しのみで計算)
+            calendar_comparisons = calculate_calendar_comparisons(
+                metric_cube, selected_store_cd_for_comparison, selected_theme_name,
+                selected_start_date, current_end_date_dt, prev_start_date_dt, prev_end_date_dt, trailing_weeks
+            )
+            calendar_comparison_strs = [
+                "<br>".join(
+                    f"{label}: {format_change_percentage_str(current_totals[m], baseline[m]) if baseline is not None else 'N/A'}"
+                    for label, current_totals, baseline in calendar_comparisons
+                )
+                for m in range(len(CUBE_METRICS))
+            ]
 
             with col1:
                 st.markdown(f"<div style='text-align: center;'>"
                             f"<div style='font-size: 1.2em; color: gray; margin-bottom: 0.2em; font-weight: bold;'>売上金額</div>"
                             f"<div style='font-size: 1.5em; font-weight: bold; margin-bottom: 0.1em;'>¥{int(current_sales_amount):,}</div>"
                             f"<div style='font-size: 1.1em; margin-top: 0.1em;'>({change_sales_amount_str})</div>"
+                            f"<div style='font-size: 0.9em; color: gray; margin-top: 0.2em;'>{calendar_comparison_strs[0]}</div>"
                             f"</div>", unsafe_allow_html=True)
             with col2:
                 st.markdown(f"<div style='text-align: center;'>"
                             f"<div style='font-size: 1.2em; color: gray; margin-bottom: 0.2em; font-weight: bold;'>売上数量</div>"
                             f"<div style='font-size: 1.5em; font-weight: bold; margin-bottom: 0.1em;'>{int(current_sales_quantity):,}個</div>"
                             f"<div style='font-size: 1.1em; margin-top: 0.1em;'>({change_sales_quantity_str})</div>"
+                            f"<div style='font-size: 0.9em; color: gray; margin-top: 0.2em;'>{calendar_comparison_strs[1]}</div>"
                             f"</div>", unsafe_allow_html=True)
             with col3:
                 st.markdown(f"<div style='text-align: center;'>"
                             f"<div style='font-size: 1.2em; color: gray; margin-bottom: 0.2em; font-weight: bold;'>ID数</div>"
                             f"<div style='font-size: 1.5em; font-weight: bold; margin-bottom: 0.1em;'>{int(current_id_count):,}</div>"
                             f"<div style='font-size: 1.1em; margin-top: 0.1em;'>({change_id_count_str})</div>"
+                            f"<div style='font-size: 0.9em; color: gray; margin-top: 0.2em;'>{calendar_comparison_strs[2]}</div>"
                             f"</div>", unsafe_allow_html=True)
             with col4:
                 st.markdown(f"<div style='text-align: center;'>"
                             f"<div style='font-size: 1.2em; color: gray; margin-bottom: 0.2em; font-weight: bold;'>レシート枚数</div>"
                             f"<div style='font-size: 1.5em; font-weight: bold; margin-bottom: 0.1em;'>{int(current_receipt_count):,}</div>"
                             f"<div style='font-size: 1.1em; margin-top: 0.1em;'>({change_receipt_count_str})</div>"
+                            f"<div style='font-size: 0.9em; color: gray; margin-top: 0.2em;'>{calendar_comparison_strs[3]}</div>"
                             f"</div>", unsafe_allow_html=True)
             
             st.markdown("<hr style='margin-top: 0.5em; margin-bottom: 0.5em;'>", unsafe_allow_html=True)